@@ -1,96 +1,104 @@
 import os
-import json
+import orjson
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
-import git
 from dotenv import load_dotenv
 from datetime import datetime
-import pytz
-import sqlite3
-
-def initialize_database():
-    conn = sqlite3.connect('play_counter.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS play_count
-                 (id INTEGER PRIMARY KEY, count INTEGER)''')
-    c.execute('SELECT count FROM play_count WHERE id=1')
-    if c.fetchone() is None:
-        c.execute('INSERT INTO play_count (id, count) VALUES (1, 0)')
-    conn.commit()
-    conn.close()
-
-def load_play_count():
-    conn = sqlite3.connect('play_counter.db')
-    c = conn.cursor()
-    c.execute('SELECT count FROM play_count WHERE id=1')
-    count = c.fetchone()[0]
-    conn.close()
-    return count
-
-def save_play_count(count):
-    conn = sqlite3.connect('play_counter.db')
-    c = conn.cursor()
-    c.execute('UPDATE play_count SET count = ? WHERE id = 1', (count,))
-    conn.commit()
-    conn.close()
+from operator import itemgetter
+from zoneinfo import ZoneInfo
+import subprocess
+
+LONDON_TZ = ZoneInfo('Europe/London')
+get_name = itemgetter('name')
 
 def fetch_spotify_data():
     sp = spotipy.Spotify(auth_manager=SpotifyOAuth(scope="user-read-recently-played"))
     return sp.current_user_recently_played(limit=50)
 
-def save_to_json(data, play_count, filename='spotify_data.json'):
+def format_played_at(dt):
+    # Equivalent to strftime('%d/%m/%Y - %H:%M:%S')
+    return (f'{dt.day:02d}/{dt.month:02d}/{dt.year:04d} - '
+            f'{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}')
+
+def save_to_json(data, filename='spotify_data.json'):
     try:
-        with open(filename, 'r', encoding='utf-8') as infile:
-            existing_data = json.load(infile)
+        with open(filename, 'rb') as infile:
+            existing_data = orjson.loads(infile.read())
+            play_count = existing_data.get('total_plays', 0)
             simplified_data = existing_data.get('tracks', [])
-    except (FileNotFoundError, json.JSONDecodeError):
+    except FileNotFoundError:
+        play_count = 0
         simplified_data = []
 
-    london_tz = pytz.timezone('Europe/London')
+    # Key on Spotify's UTC played_at, as London time repeats an hour when the clocks
+    # go back; older entries saved without played_at_utc fall back to the local string
+    existing_played_at_utc = set()
+    legacy_played_at = set()
+    for track in simplified_data:
+        if 'played_at_utc' in track:
+            existing_played_at_utc.add(track['played_at_utc'])
+        else:
+            legacy_played_at.add(track['played_at'])
+    new_tracks_count = 0
 
     for item in data['items']:
         track = item['track']
         played_at = item['played_at']
-        try:
-            played_at_dt = datetime.strptime(played_at, '%Y-%m-%dT%H:%M:%S.%fZ')
-        except ValueError:
-            played_at_dt = datetime.strptime(played_at, '%Y-%m-%dT%H:%M:%SZ')
-        
-        played_at_dt = pytz.utc.localize(played_at_dt).astimezone(london_tz)
-        formatted_played_at = played_at_dt.strftime('%d/%m/%Y - %H:%M:%S')
+        played_at_dt = datetime.fromisoformat(played_at.replace('Z', '+00:00'))
+        formatted_played_at = format_played_at(played_at_dt.astimezone(LONDON_TZ))
+        if played_at in existing_played_at_utc or formatted_played_at in legacy_played_at:
+            continue
 
         track_info = {
             'song_name': track['name'],
-            'artists': [artist['name'] for artist in track['artists']],
+            'artists': list(map(get_name, track['artists'])),
             'album': track['album']['name'],
-            'played_at': formatted_played_at
+            'played_at': formatted_played_at,
+            'played_at_utc': played_at
         }
         simplified_data.append(track_info)
+        existing_played_at_utc.add(played_at)
+        new_tracks_count += 1
 
-    simplified_data = simplified_data[-200:]
+    if new_tracks_count == 0:
+        return 0
 
-    with open(filename, 'w', encoding='utf-8') as outfile:
-        # Include the play count in the JSON file
-        json.dump({'total_plays': play_count, 'tracks': simplified_data}, outfile, ensure_ascii=False, indent=4)
+    del simplified_data[:-200]
+
+    # Sync a temporary file and rename it, so a crash keeps the old or new history whole
+    tmp_filename = filename + '.tmp'
+    try:
+        with open(tmp_filename, 'wb') as outfile:
+            # Include the play count in the JSON file
+            outfile.write(orjson.dumps({'total_plays': play_count, 'tracks': simplified_data},
+                                       option=orjson.OPT_INDENT_2))
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
 
-    save_play_count(play_count)
+    return new_tracks_count
 
 
 
 def git_commit_and_push(repo_dir, filename):
-    repo = git.Repo(repo_dir)
-    repo.git.add(filename)
-    repo.index.commit('Update listening history')
-    origin = repo.remote(name='origin')
-    origin.push()
+    subprocess.run(['git', '-C', repo_dir, 'add', '--', filename], check=True)
+    # Commit only the history file; exit code 1 means nothing to commit
+    result = subprocess.run(['git', '-C', repo_dir, 'commit', '-m', 'Update listening history',
+                             '--', filename])
+    if result.returncode == 1:
+        return
+    result.check_returncode()
+    subprocess.run(['git', '-C', repo_dir, 'push', 'origin'], check=True)
 
 def main():
     load_dotenv()
-    initialize_database()  # Ensure database is set up
-    play_count = load_play_count()
     spotify_data = fetch_spotify_data()
-    save_to_json(spotify_data, play_count, 'spotify_data.json')
-    git_commit_and_push(os.getcwd(), 'spotify_data.json')
+    if save_to_json(spotify_data, 'spotify_data.json') > 0:
+        git_commit_and_push(os.getcwd(), 'spotify_data.json')
 
 if __name__ == '__main__':
     main()